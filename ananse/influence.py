@@ -1,24 +1,27 @@
 """Predict TF influence score"""
 from heapq import heappush, heappop
+from functools import lru_cache
 from itertools import count
 import os
 import shutil
 import sys
+import tempfile
 import warnings
 import genomepy
 from typing import Union
 from collections import namedtuple
+from collections.abc import Mapping, Set
 from loguru import logger
 from tqdm.auto import tqdm
 import numpy as np
 import pandas as pd
-import networkx as nx
 import multiprocessing as mp
 from sklearn.preprocessing import minmax_scale
-from scipy.stats import rankdata, mannwhitneyu
+from scipy.sparse import csr_matrix, tril
+from scipy.sparse.csgraph import dijkstra
+from scipy.stats import rankdata, norm
 
 from . import SEPARATOR
-from .utils import mytmpdir
 
 
 warnings.filterwarnings("ignore")
@@ -36,41 +39,251 @@ GRN_COLUMNS = {
     "activity": "tf_activity",
 }
 
+
+class CSRGraph(object):
+    """
+    Directed graph, with the edges stored as a compressed sparse row (CSR) adjacency.
+
+    Node i is named node_names[i], its successors are indices[indptr[i]:indptr[i + 1]],
+    and the edge attributes are fields of a structured array in the same order as indices.
+    Supports the parts of the networkx DiGraph interface used on GRNs
+    (grn.nodes, grn.edges, grn[tf][target] and grn.out_degree(tf)).
+    """
+
+    def __init__(self, nodes, source, target, edge_attrs=None):
+        """
+        Parameters
+        ----------
+        nodes : array-like
+            node names
+        source, target : array-like
+            node indices of the edges (see split_interactions())
+        edge_attrs : pd.DataFrame or dict, optional
+            edge attribute names with an array-like of values per edge.
+            The "weight" attribute (a probability) is used for shortest paths.
+        """
+        n = len(nodes)
+        source = np.asarray(source)
+        target = np.asarray(target)
+        order = np.lexsort((target, source))
+
+        # repeated edges are collapsed into the last one (like a DiGraph would).
+        # lexsort is stable, so the last edge of each run of duplicates is kept
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = np.diff(source[order]) != 0
+        last[:-1] |= np.diff(target[order]) != 0
+        order = order[last]
+
+        self.node_names = np.asarray(nodes, dtype=object)
+        self.indptr = np.zeros(n + 1, dtype=np.int32)
+        np.cumsum(np.bincount(source[order], minlength=n), out=self.indptr[1:])
+        self.indices = target[order].astype(np.int32)
+        # one record per edge, instead of a dict of attributes per edge
+        if edge_attrs is None:
+            edge_attrs = {}
+        edge_attrs = {k: np.asarray(v) for k, v in edge_attrs.items()}
+        self.edge_attrs = np.empty(
+            len(order), dtype=[(k, v.dtype) for k, v in edge_attrs.items()]
+        )
+        for k, v in edge_attrs.items():
+            self.edge_attrs[k] = v[order]
+
+        self._index()
+
+    def _index(self):
+        """set the attributes derived from the nodes and edges"""
+        n = len(self.node_names)
+        self.node_index = {name: i for i, name in enumerate(self.node_names)}
+
+        # -log10 of the interaction probability, so it can be used as a path length
+        # (float64, as path lengths are sums of these values)
+        self.csgraph = None
+        if "weight" in self.edge_attrs.dtype.names:
+            nlog_weight = -np.log10(self.edge_attrs["weight"].astype(float))
+            self.csgraph = csr_matrix(
+                (nlog_weight, self.indices, self.indptr), shape=(n, n)
+            )
+
+    def __getstate__(self):
+        # only pickle the arrays (e.g. when sent to worker processes),
+        # the derived attributes are rebuilt when unpickled
+        state = self.__dict__.copy()
+        del state["node_index"], state["csgraph"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._index()
+
+    def __len__(self):
+        return len(self.node_names)
+
+    def __iter__(self):
+        return iter(self.node_names)
+
+    def __contains__(self, node):
+        return node in self.node_index
+
+    def __getitem__(self, node):
+        """successors of node, with their edge attributes"""
+        i = self.node_index[node]
+        edges = range(self.indptr[i], self.indptr[i + 1])
+        return {
+            self.node_names[self.indices[e]]: {
+                k: self.edge_attrs[k][e] for k in self.edge_attrs.dtype.names
+            }
+            for e in edges
+        }
+
+    @property
+    def nodes(self):
+        return _NodeView(self)
+
+    @property
+    def edges(self):
+        return _EdgeView(self)
+
+    def number_of_edges(self):
+        return len(self.indices)
+
+    def out_degree(self, node):
+        i = self.node_index[node]
+        return int(self.indptr[i + 1] - self.indptr[i])
+
+
+def split_interactions(interactions):
+    """
+    Split "TF—target" interaction names into the TF and target genes.
+
+    Returns
+    -------
+    nodes : np.ndarray
+        unique gene names
+    source, target : np.ndarray
+        index of the TF and target gene of each interaction in nodes
+    """
+    if len(interactions) == 0:
+        return np.array([], dtype=object), np.array([], int), np.array([], int)
+    # the split is a MultiIndex: unique TFs and targets, with a code per interaction,
+    # so the nodes are derived from the unique genes instead of all interactions
+    split = pd.Index(interactions).str.split(SEPARATOR, n=1, expand=True)
+    # names without a separator have no target (code -1)
+    if split.nlevels < 2 or (split.codes[1] == -1).any():
+        bad = next(i for i in interactions if SEPARATOR not in i)
+        raise ValueError(
+            f"Interactions must be formatted as 'TF{SEPARATOR}target', found '{bad}'!"
+        )
+    tfs, targets = split.levels
+    nodes = tfs.union(targets)
+    source = nodes.get_indexer(tfs)[split.codes[0]]
+    target = nodes.get_indexer(targets)[split.codes[1]]
+    return nodes.to_numpy(dtype=object), source, target
+
+
+class _NodeView(Set):
+    """Set-like view of the nodes of a CSRGraph"""
+
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __contains__(self, node):
+        return node in self._graph
+
+    def __iter__(self):
+        return iter(self._graph)
+
+    def __len__(self):
+        return len(self._graph)
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+
+class _EdgeView(Set):
+    """Set-like view of the (source, target) names of the edges of a CSRGraph"""
+
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __contains__(self, edge):
+        g = self._graph
+        source, target = edge
+        if source not in g or target not in g:
+            return False
+        i = g.node_index[source]
+        return g.node_index[target] in g.indices[g.indptr[i] : g.indptr[i + 1]]
+
+    def __iter__(self):
+        g = self._graph
+        source = np.repeat(g.node_names, np.diff(g.indptr))
+        return zip(source, g.node_names[g.indices])
+
+    def __len__(self):
+        return self._graph.number_of_edges()
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+
+class ExpressionChange(Mapping):
+    """
+    Expression scores of genes, stored as arrays (in the order of genes).
+
+    Maps gene names to their Expression(score, absfc, realfc).
+    """
+
+    def __init__(self, genes, score, absfc, realfc):
+        self.genes = pd.Index(genes)
+        self.score = np.asarray(score, dtype=float)
+        self.absfc = np.asarray(absfc, dtype=float)
+        self.realfc = np.asarray(realfc, dtype=float)
+        self._index = {gene: i for i, gene in enumerate(self.genes)}
+
+    def __getitem__(self, gene):
+        i = self._index[gene]
+        return Expression(self.score[i], self.absfc[i], self.realfc[i])
+
+    def __contains__(self, gene):
+        return gene in self._index
+
+    def __iter__(self):
+        return iter(self.genes)
+
+    def __len__(self):
+        return len(self.genes)
+
+
 # This piece of code is adapted from the networkx code licensed under a 3-clause license:
 # https://networkx.org/documentation/networkx-2.7/#license
-def dijkstra_prob_length(G, source, weight, cutoff=None, target=None):  # noqa
+def dijkstra_prob_length(csgraph, source, cutoff=None, target=None, max_steps=None):
     """Uses Dijkstra's algorithm to find shortest weighted paths
 
     Parameters
     ----------
-    G : NetworkX graph
-    source : node
-        Starting node for paths.
-    weight: string
-        Name of attribute that contains weight (as a probability between 0 and 1,
-        where 0 is the minimum and 1 the maximum).
-    target : node label, optional
-        Ending node for path. Search is halted when target is found.
+    csgraph : scipy.sparse.csr_matrix
+        Adjacency matrix with the -log10 of the interaction probability
+        (between 0 and 1, where 0 is the minimum and 1 the maximum) as edge data.
+        See CSRGraph.csgraph.
+    source : int
+        Index of the starting node for paths.
+    target : int, optional
+        Index of the ending node for path. Search is halted when target is found.
     cutoff : integer or float, optional
         Minimum combined, weighted probability.
         If cutoff is provided, only return paths with summed weight >= cutoff.
+    max_steps : int, optional
+        Only consider nodes up to this many steps away from the source.
 
     Returns
     -------
-    paths, distance : dictionaries
-        Dictionary of shortest paths keyed by target, and
-        a mapping from node to shortest distance to that node from one
+    pred, distance : dictionaries
+        Mapping from node index to the previous node index on its shortest path
+        (follow pred back to the source to obtain the path), and
+        a mapping from node index to shortest distance to that node from one
         of the source nodes.
-
-    Raises
-    ------
-    NodeNotFound
-        If the `source` is not in `G`.
     """
-    # cumulative weight function for values < 1
-    weight_function = lambda u, v, data: -np.log10(data[weight])  # noqa
-    paths = {source: [source]}
-
     if cutoff == 0:
         cutoff = None
     if cutoff is not None:
@@ -80,54 +293,89 @@ def dijkstra_prob_length(G, source, weight, cutoff=None, target=None):  # noqa
             )
         cutoff = -np.log10(cutoff)
 
-    G_succ = G._succ if G.is_directed() else G._adj  # noqa
+    n = csgraph.shape[0]
+    in_reach = None
+    max_length = n
+    if max_steps is not None:
+        # nodes within max_steps (similar to nx.ego_graph), using scipy's C implementation
+        steps = dijkstra(csgraph, indices=source, unweighted=True, limit=max_steps)
+        in_reach = np.isfinite(steps)
+        max_length = int(in_reach.sum())
+
+    # This is the major difference, both probability and length are taken
+    # into account: extending a path of length n adds log10(n) - log10(n - 1)
+    length_penalty = np.zeros(max_length + 1)
+    length_penalty[2:] = np.diff(np.log10(np.arange(1, max_length + 1)))
+
+    indptr = csgraph.indptr
+    indices = csgraph.indices
+    data = csgraph.data
+
+    # per node state as arrays, so successors can be relaxed all at once
+    pred = np.full(n, -1)  # previous node on the shortest path
+    length = np.zeros(n, dtype=int)  # number of nodes in the shortest path
+    seen = np.full(n, np.inf)  # shortest distance found so far
+    done = np.zeros(n, dtype=bool)  # shortest distance is final
+
+    # nodes without successors are never expanded, so their shortest distance
+    # is final after the search, without passing through the heap
+    # (unless the search has to halt at the target)
+    deferred = np.zeros(n, dtype=bool)
+    if target is None:
+        deferred = np.diff(indptr) == 0
 
     push = heappush
     pop = heappop
     dist = {}  # dictionary of final distances
-    seen = {}
     # fringe is heapq with 3-tuples (distance,c,node)
     # use the count c to avoid comparing nodes (may not be able to)
     c = count()
     fringe = []
 
+    length[source] = 1
     seen[source] = 0
     push(fringe, (0, next(c), source))
     while fringe:
         (d, _, v) = pop(fringe)
-        if v in dist:
+        if done[v]:
             continue  # already searched this node.
+        done[v] = True
         dist[v] = d
         if v == target:
             break
-        for u, e in G_succ[v].items():
-            cost = weight_function(v, u, e)
-            if cost is None:
-                continue
-
-            # This is the major difference, both probability and length are taken
-            # into account
-            length = len(paths[v])
-            vu_dist = dist[v] + cost - np.log10(1 / length)  # noqa
-            if length > 1:
-                vu_dist = vu_dist + np.log10(1 / (length - 1))
-
-            if cutoff is not None:
-                if vu_dist > cutoff:
-                    continue
-            if u in dist:
-                u_dist = dist[u]
-                if vu_dist < u_dist:
-                    raise ValueError("Contradictory paths found:", "negative weights?")
-            elif u not in seen or vu_dist < seen[u]:
-                seen[u] = vu_dist
-                push(fringe, (vu_dist, next(c), u))
-                if paths is not None:
-                    paths[u] = paths[v] + [u]  # noqa
-
-    paths = {k: v for k, v in paths.items() if len(v) > 1}
-    dist = {k: 10**-v for k, v in dist.items() if k in paths}
-    return paths, dist
+        start, end = indptr[v], indptr[v + 1]
+        if start == end:
+            continue
+
+        # distances and cutoff for all successors at once
+        successors = indices[start:end]
+        vu_dists = d + data[start:end] + length_penalty[length[v]]
+        keep = np.ones(len(successors), dtype=bool)
+        if in_reach is not None:
+            keep &= in_reach[successors]
+        if cutoff is not None:
+            keep &= vu_dists <= cutoff
+
+        shorter = keep & (vu_dists < seen[successors])
+        if (shorter & done[successors]).any():
+            raise ValueError("Contradictory paths found:", "negative weights?")
+        if not shorter.any():
+            continue
+        successors = successors[shorter]
+        vu_dists = vu_dists[shorter]
+        seen[successors] = vu_dists
+        pred[successors] = v
+        length[successors] = length[v] + 1
+        queue = ~deferred[successors]
+        for u, vu_dist in zip(successors[queue].tolist(), vu_dists[queue].tolist()):
+            push(fringe, (vu_dist, next(c), u))
+
+    leaves = np.flatnonzero(deferred & ~done & np.isfinite(seen))
+    dist.update(zip(leaves.tolist(), seen[leaves].tolist()))
+    reached = np.flatnonzero(pred >= 0)
+    pred = dict(zip(reached.tolist(), pred[reached].tolist()))
+    dist = {k: 10**-v for k, v in dist.items() if k in pred}
+    return pred, dist
 
 
 def read_network(fname, full_output=False):
@@ -151,18 +399,34 @@ def read_network(fname, full_output=False):
             "activity",
         ]
     # read the GRN file
+    # tf_target is parsed as string by default,
+    # only the score columns need a dtype (no per-value converters)
     rnet = pd.read_csv(
         fname,
         sep="\t",
         usecols=data_columns,
-        dtype="float64",
-        converters={"tf_target": str},
-        index_col="tf_target",
-    )
+        dtype={col: "float32" for col in data_columns[1:]},
+        engine="c",
+    ).set_index("tf_target")
 
     return rnet
 
 
+def top_interactions(network, edges, sort_by="prob"):
+    """
+    Return the edges interactions with the highest sort_by score (in ascending order).
+
+    Selects the top interactions before sorting, instead of sorting the whole network.
+    """
+    scores = network[sort_by].to_numpy()
+    top = np.arange(len(scores))
+    if edges < len(scores):
+        # partial sort: the last edges positions hold the highest scores
+        top = np.argpartition(scores, -edges)[-edges:] if edges > 0 else top[:0]
+    top = top[np.argsort(scores[top], kind="stable")]
+    return network.iloc[top]
+
+
 def read_network_to_graph(
     fname,
     edges: Union[int, None] = 100_000,
@@ -171,30 +435,45 @@ def read_network_to_graph(
     full_output=False,
 ):
     """
-    Read a network file and return a networkx DiGraph.
+    Read a network file and return a CSRGraph.
 
     Subsets the graph to interactions if given, else to the number top interactions given by edges.
     If both interactions and edges are none, return the whole graph.
 
     Peak memory usage is about ~5GB per million edges (tested with 0.1m, 1m and 10m edges)
+
+    The graph is cached per file version and arguments,
+    so repeated reads return the same (unmodified) graph.
     """
+    stat = os.stat(fname)
+    if interactions is not None:
+        interactions = tuple(interactions)
+    return _read_network_to_graph(
+        fname,
+        (stat.st_mtime, stat.st_size),
+        edges,
+        interactions,
+        sort_by,
+        full_output,
+    )
+
+
+@lru_cache(maxsize=2)
+def _read_network_to_graph(fname, version, edges, interactions, sort_by, full_output):
     rnet = read_network(fname, full_output)
     if interactions is not None:
         rnet = rnet[rnet.index.isin(interactions)]
     elif edges is not None:
-        rnet = rnet.sort_values(sort_by).tail(edges)
+        rnet = top_interactions(rnet, edges, sort_by)
 
-    # split the transcription factor and target gene into 2 columns
-    rnet[["source", "target"]] = rnet.index.to_series().str.split(
-        SEPARATOR, expand=True
-    )
-    rnet.reset_index(drop=True, inplace=True)
+    # split the transcription factor and target gene
+    nodes, source, target = split_interactions(rnet.index)
 
     # rename the columns
     rnet.rename(columns=GRN_COLUMNS, inplace=True)
 
     # load into a network with TFs and TGs as nodes, and the interaction scores as edges
-    grn = nx.from_pandas_edgelist(rnet, edge_attr=True, create_using=nx.DiGraph)
+    grn = CSRGraph(nodes, source, target, rnet)
 
     return grn
 
@@ -221,29 +500,43 @@ def difference(
     logger.info("Loading source network.")
     source = read_network(grn_source, full_output)
     if edges and not select_after_join:
-        source = source.sort_values(sort_by).tail(edges)
+        source = top_interactions(source, edges, sort_by)
     source.rename(columns=GRN_COLUMNS, inplace=True)
 
     logger.info("Loading target network.")
     target = read_network(grn_target, full_output)
     if edges and not select_after_join:
         logger.info(f"    Selecting top {edges} edges before calculating difference")
-        target = target.sort_values(sort_by).tail(edges)
+        target = top_interactions(target, edges, sort_by)
     target.rename(columns=GRN_COLUMNS, inplace=True)
 
     # Calculate difference
     logger.info("Calculating differential network.")
-    # Fill weight not present in source network with 0
-    diff_network = target.join(source, lsuffix="_target", rsuffix="_source").fillna(0)
-    diff_network["weight"] = (
-        diff_network["weight_target"] - diff_network["weight_source"]
-    )
+    # Repeated interactions can't be matched, keep the last (like the graph would)
+    source = source[~source.index.duplicated(keep="last")]
+    # Position of each target edge in the source network,
+    # so the interactions are only matched once.
+    # Edges not present in the source network (-1) get the padded 0 at the end.
+    pos = source.index.get_indexer(target.index)
+    source_weight = np.pad(source["weight"].to_numpy(), (0, 1))[pos]
+    weight = target["weight"].to_numpy() - source_weight
 
     # Only keep edges that are higher in target network
-    diff_network = diff_network[diff_network["weight"] > 0]
-
-    if not full_output:
-        diff_network.drop(columns=["weight_target", "weight_source"], inplace=True)
+    keep = weight > 0
+    if full_output:
+        source_data = np.pad(source.to_numpy(), ((0, 1), (0, 0)))[pos[keep]]
+        diff_network = pd.concat(
+            [
+                target[keep].add_suffix("_target"),
+                pd.DataFrame(
+                    source_data, index=target.index[keep], columns=source.columns
+                ).add_suffix("_source"),
+            ],
+            axis=1,
+        ).fillna(0)
+        diff_network["weight"] = weight[keep]
+    else:
+        diff_network = pd.DataFrame({"weight": weight[keep]}, index=target.index[keep])
 
     # Only keep top edges
     if edges and select_after_join:
@@ -253,41 +546,102 @@ def difference(
             diff_network[sort_by] = (
                 diff_network[f"{sort_by}_target"] - diff_network[f"{sort_by}_source"]
             )
-        diff_network = diff_network.sort_values(sort_by).tail(edges)
-
-    # split the transcription factor and target gene into 2 columns, make sure they end up
-    # in the first columns
-    source_target = (
-        diff_network.index.to_series()
-        .str.split(SEPARATOR, expand=True)
-        .rename(columns={0: "source", 1: "target"})
-    )
-    diff_network = pd.concat((source_target, diff_network), axis=1)
-    diff_network.reset_index(drop=True, inplace=True)
+        diff_network = top_interactions(diff_network, edges, sort_by)
+
+    # load into a network with TFs and TGs as nodes, and the interaction scores as edges
+    nodes, source, target = split_interactions(diff_network.index)
+    grn = CSRGraph(nodes, source, target, diff_network)
 
     if outfile:
+        # split the transcription factor and target gene into 2 columns, make sure they end up
+        # in the first columns (inserted, instead of concatenating a copy of the network)
+        diff_network.insert(0, "source", nodes[source])
+        diff_network.insert(1, "target", nodes[target])
+        diff_network.reset_index(drop=True, inplace=True)
+
         logger.info("Saving differential network.")
         diff_network.to_csv(outfile, sep="\t", index=False)
 
-    # load into a network with TFs and TGs as nodes, and the interaction scores as edges
-    grn = nx.from_pandas_edgelist(diff_network, edge_attr=True, create_using=nx.DiGraph)
-
     return grn
 
 
-def target_score(expression_change, targets):
+def de_gene_scores(grn, expression_change, de_genes=None):
+    """
+    Return the expression score of each node in the GRN (in grn.node_names order),
+    or 0 if the node is not a differentially expressed gene
+    (by default, genes with a score > 0).
+    """
+    # nodes not in expression_change (-1) get the padded 0 at the end
+    pos = expression_change.genes.get_indexer(grn.node_names)
+    gscore = np.pad(expression_change.score, (0, 1))[pos]
+    if de_genes is not None:
+        gscore[~pd.Index(grn.node_names).isin(list(de_genes))] = 0.0
+    return gscore
+
+
+def target_score(gscore, targets, weights):
     """
     Calculate the target score, as (mostly) explained in equation 5:
     https://academic.oup.com/nar/article/49/14/7966/6318498#M5
+
+    Parameters
+    ----------
+    gscore : np.ndarray
+        expression score per node (see de_gene_scores())
+    targets : np.ndarray
+        node indices of the targets
+    weights : np.ndarray
+        cumulative probability normalized by the length, per target
     """
-    ts = 0
-    for target, weight in targets.items():
-        # g: expression score of the target
-        g = expression_change[target].score
-        # weight: cumulative probability normalized by the length
-        score = g * weight
-        ts += score
-    return ts
+    return gscore[targets] @ weights
+
+
+def network_target_scores(node, grn, gscore, max_steps=2):
+    """
+    Return the number of genes up to max_steps away from a transcription factor,
+    and its target score (the part of tf_target_scores() that requires a graph search).
+    """
+    # sum target scores for all genes that are
+    # - up to 'max_steps' away from the TF
+    # - differentially expressed
+    # dijkstra_prob_length cutoff between 0.25 to 0.32 yields the same targets
+    pred, weights = dijkstra_prob_length(
+        grn.csgraph, grn.node_index[node], max_steps=max_steps
+    )
+    targetscore = target_score(
+        gscore,
+        np.fromiter(weights.keys(), dtype=int, count=len(weights)),
+        np.fromiter(weights.values(), dtype=float, count=len(weights)),
+    )
+    return len(pred), targetscore
+
+
+def tf_target_scores(node, grn, expression_change, de_genes, max_steps=2, gscore=None):
+    """
+    Calculate the target scores of a transcription factor.
+
+    Parameters are the same as influence_scores(), and optionally
+    the precomputed de_gene_scores().
+
+    Returns
+    -------
+    tuple
+        interaction data of the given transcription factor,
+        without the fold change scores (see fold_change_scores())
+    """
+    if gscore is None:
+        gscore = de_gene_scores(grn, expression_change, de_genes)
+    total_targets, targetscore = network_target_scores(node, grn, gscore, max_steps)
+
+    factor_fc = expression_change[node].absfc if node in expression_change else 0
+    return (
+        node,  # factor
+        grn.out_degree(node),  # noqa. direct_targets
+        total_targets,  # total_targets
+        targetscore,  # target_score
+        expression_change[node].score,  # G_score
+        factor_fc,  # factor_fc
+    )
 
 
 def influence_scores(node, grn, expression_change, de_genes, max_steps=2):
@@ -298,10 +652,10 @@ def influence_scores(node, grn, expression_change, de_genes, max_steps=2):
     ----------
     node : str
         Transcription factor name, present in grn as a node
-    grn : nx.DiGraph
+    grn : CSRGraph
         A network with gene names as nodes and interaction scores as weights
-    expression_change : dict
-        A dictionary with interaction scores and log fold changes per transcription factor
+    expression_change : ExpressionChange
+        A mapping with interaction scores and log fold changes per transcription factor
     de_genes : list or set or dict
         A list-like with genes present in expression_change that have a score > 0
     max_steps : int
@@ -313,57 +667,76 @@ def influence_scores(node, grn, expression_change, de_genes, max_steps=2):
     tuple
         interaction data of the given transcription factor
     """
-    # sum target scores for all genes that are
-    # - up to 'max_steps' away from the TF
-    # - differentially expressed
-    sub_grn = nx.generators.ego_graph(grn, node, radius=max_steps)
-    # dijkstra_prob_length cutoff between 0.25 to 0.32 yields the same targets
-    paths, weights = dijkstra_prob_length(sub_grn, node, "weight")
-    de_targets = {k: v for k, v in weights.items() if k in de_genes}
-    targetscore = target_score(expression_change, de_targets)
-
-    pval, target_fc_diff = fold_change_scores(node, grn, expression_change)
-    factor_fc = expression_change[node].absfc if node in expression_change else 0
-    return (
-        node,  # factor
-        grn.out_degree(node),  # noqa. direct_targets
-        len(paths),  # total_targets
-        targetscore,  # target_score
-        expression_change[node].score,  # G_score
-        factor_fc,  # factor_fc
-        pval,  # pval
-        target_fc_diff,  # target_fc
+    pval, target_fc_diff = fold_change_scores([node], grn, expression_change)
+    return tf_target_scores(node, grn, expression_change, de_genes, max_steps) + (
+        pval[0],  # pval
+        target_fc_diff[0],  # target_fc
     )
 
 
-def fold_change_scores(node, grn, expression_change):
+# network_target_scores() arguments shared by all TFs.
+# Set once per worker process, so only the TF name is sent per job.
+_worker_args = ()
+
+
+def _init_influence_worker(grn, gscore):
+    global _worker_args
+    _worker_args = (grn, gscore)
+
+
+def _network_target_scores_worker(node):
+    grn, gscore = _worker_args
+    return network_target_scores(node, grn, gscore)
+
+
+def fold_change_scores(nodes, grn, expression_change):
     """
     Get the Mann-Whitney U p-value of direct targets vs. non-direct targets,
-    as well as the difference of the mean fold changes.
-    """
-    direct_targets = set(grn[node]) & set(expression_change)
-    if len(direct_targets) == 0:
-        return np.NAN, np.NAN
-    non_direct_targets = (set(grn.nodes) & set(expression_change)) - direct_targets
-    if len(non_direct_targets) == 0:
-        return np.NAN, np.NAN
+    as well as the difference of the mean fold changes, for each node.
 
-    target_fc = [expression_change[t].absfc for t in direct_targets]
-    non_target_fc = [expression_change[t].absfc for t in non_direct_targets]
-    try:
-        # asymptotic method prevents recursion errors.
-        # TODO: review when scipy closes https://github.com/scipy/scipy/issues/14622
-        pval = mannwhitneyu(target_fc, non_target_fc, method="asymptotic")[1]
-    except (RecursionError, ValueError) as e:
-        pval = np.NAN
-        logger.warning(e)
-        # logger.warning(
-        #     f"Could not calculate p-val (target vs non-target fold-change) for {node}, "
-        #     f"targets = {len(target_fc)}, non-target = {len(non_target_fc)}."
-        # )
-        # logger.warning(f"targets = {target_fc[0:min(5, len(target_fc))]}...")
-        # logger.warning(f"non_target = {non_target_fc[0:min(5, len(non_target_fc))]}...")
-    target_fc_diff = np.mean(target_fc) - np.mean(non_target_fc)
+    Every test compares a split of the same genes (present in both the
+    network and expression_change), so the genes are ranked once and the
+    rank sums of all nodes are obtained with a single sparse matrix product.
+    The p-value is the two-sided asymptotic p-value of scipy's mannwhitneyu.
+
+    Returns
+    -------
+    pval, target_fc_diff : np.ndarray
+        NaN for nodes without direct, or without non-direct targets
+    """
+    genes = grn.node_names
+    pos = expression_change.genes.get_indexer(genes)
+    in_expression = pos >= 0
+    absfc = np.where(in_expression, expression_change.absfc[pos], 0.0)
+    ranks = np.zeros(len(genes))
+    ranks[in_expression] = rankdata(absfc[in_expression])
+    _, ties = np.unique(absfc[in_expression], return_counts=True)
+    tie_term = (ties**3 - ties).sum()
+
+    # direct targets (present in expression_change) of each node
+    rows = [grn.node_index[node] for node in nodes]
+    structure = csr_matrix(
+        (np.ones(len(grn.indices)), grn.indices, grn.indptr), (len(genes), len(genes))
+    )
+    targets = structure[rows].multiply(in_expression).tocsr()
+    n = in_expression.sum()
+    n1 = targets.sum(axis=1).A1
+    n2 = n - n1
+    fc1 = targets @ absfc
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        target_fc_diff = fc1 / n1 - (absfc.sum() - fc1) / n2
+
+        # scipy.stats.mannwhitneyu(target_fc, non_target_fc, method="asymptotic")
+        u1 = targets @ ranks - n1 * (n1 + 1) / 2
+        u = np.maximum(u1, n1 * n2 - u1)
+        s = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+        z = (u - n1 * n2 / 2 - 0.5) / s
+    pval = np.clip(2 * norm.sf(z), 0, 1)
+
+    no_test = (n1 == 0) | (n2 == 0)
+    pval[no_test] = np.NAN
+    target_fc_diff[no_test] = np.NAN
     return pval, target_fc_diff
 
 
@@ -379,28 +752,66 @@ def filter_tf(scores_df, network=None, tpmfile=None, tpm=20, overlap=0.98):
         for line in tpf:
             tpmscore[line.split()[0]] = float(line.split()[1])
 
-    tftarget = {}
-    for tf in scores_df.index:
-        tftarget[tf] = set(network[tf]) if tf in network else set()
-
-    ltf = list(scores_df.index)
-
-    keeptf = []
-    for i in ltf:
-        passtf = []
-        if len(tftarget[i]) > 0:
-            for j in ltf[: ltf.index(i)]:
-                if len(tftarget[i] & tftarget[j]) / len(tftarget[i]) > overlap:
-                    break
-                else:
-                    passtf.append(j)
-            if passtf == ltf[: ltf.index(i)] and i in tpmscore and tpmscore[i] < tpm:
-                keeptf.append(i)
-    scores_df = scores_df.loc[keeptf]
+    # targets of each TF, in order of scores_df (TFs not in the network have none)
+    n = len(network)
+    nnz = network.number_of_edges()
+    targets = csr_matrix(
+        (np.ones(nnz), network.indices, np.append(network.indptr, nnz)),
+        shape=(n + 1, n),
+    )[[network.node_index.get(tf, n) for tf in scores_df.index]]
+    n_targets = targets.sum(axis=1).A1
+
+    # number of targets shared with each higher ranked TF
+    shared = tril(targets @ targets.T, k=-1).tocoo()
+    redundant = np.zeros(len(scores_df), dtype=bool)
+    redundant[shared.row[shared.data / n_targets[shared.row] > overlap]] = True
+
+    low_tpm = np.array([tpmscore.get(tf, tpm) < tpm for tf in scores_df.index])
+    keep = (n_targets > 0) & ~redundant & low_tpm
+    scores_df = scores_df[keep]
     scores_df.sort_values("sumScaled", inplace=True, ascending=False)
     return scores_df
 
 
+def attribute_dict(attributes, key, value):
+    """
+    Return a dict with the first value per key,
+    from a dataframe with GTF attribute fields as columns.
+    """
+    pairs = attributes[[key, value]].dropna().drop_duplicates(key)
+    return dict(zip(pairs[key], pairs[value]))
+
+
+def gene_id_dicts(gene_gtf):
+    """
+    Return dicts converting transcript IDs to gene IDs,
+    transcript IDs to gene names and gene IDs to gene names.
+
+    Cached per annotation (and file version), as parsing a GTF is slow.
+    """
+    version = None
+    if os.path.isfile(gene_gtf):
+        stat = os.stat(gene_gtf)
+        version = (stat.st_mtime, stat.st_size)
+    return _gene_id_dicts(gene_gtf, version)
+
+
+@lru_cache(maxsize=2)
+def _gene_id_dicts(gene_gtf, version):
+    # extract the IDs from the GTF attributes once, for all 3 conversions
+    gp = genomepy.Annotation(gene_gtf)
+    ids = pd.DataFrame(
+        {
+            field: gp.from_attributes(field, check=False)
+            for field in ["transcript_id", "gene_id", "gene_name"]
+        }
+    )
+    tid2gid = attribute_dict(ids, "transcript_id", "gene_id")
+    tid2name = attribute_dict(ids, "transcript_id", "gene_name")
+    gid2name = attribute_dict(ids, "gene_id", "gene_name")
+    return tid2gid, tid2name, gid2name
+
+
 class Influence(object):
     def __init__(
         self,
@@ -451,10 +862,12 @@ class Influence(object):
                 select_after_join,
             )
 
-            if len(self.grn.edges) == 0:
+            if self.grn.number_of_edges() == 0:
                 logger.error("No differences between networks!")
                 sys.exit(1)
-            logger.info(f"    Differential network has {len(self.grn.edges)} edges.")
+            logger.info(
+                f"    Differential network has {self.grn.number_of_edges()} edges."
+            )
 
         # Load expression file
         self.expression_change = self.read_expression(degenes, padj_cutoff)
@@ -462,7 +875,7 @@ class Influence(object):
     def read_expression(self, fname, padj_cutoff=0.05):
         """
         Read differential gene expression analysis output,
-        return dictionary with namedtuples of scores, absolute fold
+        return a mapping with namedtuples of scores, absolute fold
         change and "real" (directional) fold change.
 
         Parameters
@@ -479,7 +892,7 @@ class Influence(object):
 
         Returns
         -------
-        dict
+        ExpressionChange
             namedtuples of scores, absolute fold change and "real" (directional) fold change.
         """
         cutoff = 0.6  # fraction of overlap that is "good enough"
@@ -517,10 +930,7 @@ class Influence(object):
             backup_pct_overlap = pct_overlap
             backup_df = df.copy()
 
-            gp = genomepy.Annotation(self.gene_gtf)
-            tid2gid = gp.gtf_dict("transcript_id", "gene_id")
-            tid2name = gp.gtf_dict("transcript_id", "gene_name")
-            gid2name = gp.gtf_dict("gene_id", "gene_name")
+            tid2gid, tid2name, gid2name = gene_id_dicts(self.gene_gtf)
             df = (
                 df.rename(index=tid2name)
                 .rename(index=tid2gid)
@@ -573,19 +983,19 @@ class Influence(object):
         # get the gscore (absolute fold change if significantly differential)
         df["score"] = df["fc"] * (df["padj"] < padj_cutoff)
 
-        expression_change = dict()
-        for k, row in df.iterrows():
-            expression_change[k] = Expression(
-                score=row.score, absfc=row.fc, realfc=row.log2FoldChange
-            )
+        expression_change = ExpressionChange(
+            df.index,
+            score=df["score"].to_numpy(),
+            absfc=df["fc"].to_numpy(),
+            realfc=df["log2FoldChange"].to_numpy(),
+        )
         return expression_change
 
     def run_target_score(self):
         """Run target score for all TFs."""
 
-        tfs = [
-            node for node in self.grn.nodes() if self.grn.out_degree(node) > 0  # noqa
-        ]
+        # nodes with outgoing edges
+        tfs = self.grn.node_names[np.diff(self.grn.indptr) > 0].tolist()
         logger.info(f"Differential network contains {len(tfs)} transcription factors.")
 
         # differentially expressed TFs
@@ -606,49 +1016,58 @@ class Influence(object):
         else:
             logger.info(f"    Out of these, {len(de_tfs)} are upregulated.")
 
-        # differentially expressed genes
-        genes = self.grn.nodes
-        logger.info(f"Differential network contains {len(genes)} genes.")
-        de_genes = set(
-            g
-            for g in self.expression_change
-            if g in genes and self.expression_change[g].score > 0
-        )
+        # differentially expressed genes (node indices)
+        logger.info(f"Differential network contains {len(self.grn)} genes.")
+        expression_change = self.expression_change
+        gscore = de_gene_scores(self.grn, expression_change)
+        de_genes = np.flatnonzero(gscore > 0)
         logger.info(f"    Out of these, {len(de_genes)} are differentially expressed.")
 
-        tmpdir = mytmpdir()
+        # target vs. non-target fold change tests for all TFs at once
+        de_tfs = list(de_tfs)
+        pvals, target_fcs = fold_change_scores(de_tfs, self.grn, self.expression_change)
+
+        # a temp dir per run (concurrent runs and forked workers share mytmpdir())
+        tmpdir = tempfile.mkdtemp(prefix=f"ANANSE_{os.getpid()}.")
         tmpfile = os.path.join(tmpdir, os.path.basename(self.outfile))
-        influence_file = open(tmpfile, "w")
-        influence_file.write(
-            "factor\tdirect_targets\ttotal_targets\ttarget_score\tG_score\tfactor_fc\tpval\ttarget_fc\n"
-        )
 
         try:
+            # only the graph search is done per TF
             if self.ncore > 1:
-                pool = mp.Pool(self.ncore)
-                jobs = []
-                for tf in de_tfs:
-                    jobs.append(
-                        pool.apply_async(
-                            influence_scores,
-                            (tf, self.grn, self.expression_change, de_genes),
-                        )
-                    )
+                pool = mp.Pool(
+                    self.ncore,
+                    initializer=_init_influence_worker,
+                    initargs=(self.grn, gscore),
+                )
+                # send the TFs in chunks, to reduce the number of messages per TF
+                chunksize = max(1, len(de_tfs) // (4 * self.ncore))
+                jobs = pool.imap(_network_target_scores_worker, de_tfs, chunksize)
                 pool.close()
-                with tqdm(total=len(jobs)) as pbar:
-                    for j in jobs:
-                        print(*j.get(), file=influence_file, sep="\t")
-                        pbar.update(1)
+                network_scores = list(tqdm(jobs, total=len(de_tfs)))
                 pool.join()
 
             else:
-                for tf in tqdm(de_tfs):
-                    line = influence_scores(
-                        tf, self.grn, self.expression_change, de_genes
-                    )
-                    print(*line, file=influence_file, sep="\t")
-
-            influence_file.close()
+                network_scores = [
+                    network_target_scores(tf, self.grn, gscore) for tf in tqdm(de_tfs)
+                ]
+            total_targets, target_scores = zip(*network_scores)
+
+            # the remaining scores are computed for all TFs at once
+            rows = [self.grn.node_index[tf] for tf in de_tfs]
+            pos = expression_change.genes.get_indexer(de_tfs)
+            scores = pd.DataFrame(
+                {
+                    "factor": de_tfs,
+                    "direct_targets": np.diff(self.grn.indptr)[rows],
+                    "total_targets": total_targets,
+                    "target_score": target_scores,
+                    "G_score": expression_change.score[pos],
+                    "factor_fc": expression_change.absfc[pos],
+                    "pval": pvals,
+                    "target_fc": target_fcs,
+                }
+            )
+            scores.to_csv(tmpfile, sep="\t", index=False)
             shutil.move(tmpfile, self.outfile)
 
         except Exception as e:
@@ -665,6 +1084,9 @@ class Influence(object):
                 sys.exit(1)
             raise e
 
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
     def run_influence_score(self, influence_file, fin_expression=None):
         """Calculate influence score from target score and gscore"""
 
@@ -712,3 +1134,54 @@ class Influence(object):
 
         logger.info("Calculating influence scores.")
         self.run_influence_score(self.outfile, fin_expression)
+
+
+def _influence_files(outfile):
+    """All files Influence.run_influence() may write, given its outfile"""
+    return [
+        outfile,
+        os.path.splitext(outfile)[0] + "_diffnetwork.tsv",
+        ".".join(outfile.split(".")[:-1]) + "_filtered.txt",
+    ]
+
+
+def _run_influence(params):
+    """Run ANANSE influence with the Influence() arguments in params"""
+    params = dict(params)
+    fin_expression = params.pop("fin_expression", None)
+    try:
+        Influence(**params).run_influence(fin_expression)
+    except SystemExit:
+        # the error is logged, but exiting would leave a worker pool waiting
+        raise RuntimeError(f"ANANSE influence failed for {params['outfile']}")
+    return params["outfile"]
+
+
+def run_influence_many(param_list, ncore=1):
+    """
+    Run ANANSE influence for each dict of Influence() arguments in param_list
+    (e.g. to compare settings), running up to ncore settings in parallel.
+    A dict may contain the "fin_expression" argument of Influence.run_influence().
+
+    Returns
+    -------
+    list
+        the outfile of each run
+    """
+    # runs may not (over)write each other's files
+    written = {}
+    for n, params in enumerate(param_list):
+        for fname in _influence_files(params["outfile"]):
+            other = written.setdefault(os.path.abspath(fname), n)
+            if other != n:
+                raise ValueError(
+                    f"Each run requires a distinct outfile! "
+                    f"Runs {other} and {n} both write to {fname}."
+                )
+
+    if ncore > 1 and len(param_list) > 1:
+        # each run uses a single core
+        param_list = [dict(params, ncore=1) for params in param_list]
+        with mp.Pool(min(ncore, len(param_list))) as pool:
+            return pool.map(_run_influence, param_list)
+    return [_run_influence(params) for params in param_list]
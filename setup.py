@@ -49,7 +49,7 @@ setup(
         "scipy",
         "scikit-learn",
         "tables",
-        "genomepy >=0.11.0",
+        "genomepy >=0.12.0",
         "pyranges",
         "seaborn",
         "tqdm",
@@ -1,7 +1,9 @@
 import os
 
+import numpy as np
 import pandas as pd
 import pytest
+from scipy.stats import mannwhitneyu
 
 import ananse.influence
 
@@ -51,8 +53,40 @@ def test_read_network_to_graph():
     assert "tf_activity" in grn["FOXK2"]["AL935186.11"].keys()
 
 
-def test_difference():
-    pass  # TODO
+def test_csrgraph():
+    interactions = ["A—B", "A—C", "A—B", "C—B"]
+    nodes, source, target = ananse.influence.split_interactions(interactions)
+    grn = ananse.influence.CSRGraph(
+        nodes, source, target, {"weight": np.array([0.1, 0.2, 0.3, 0.4])}
+    )
+    # duplicate edges are collapsed into the last one
+    assert grn.number_of_edges() == 3
+    assert grn.out_degree("A") == 2
+    assert grn["A"]["B"]["weight"] == 0.3
+
+
+def test_split_interactions():
+    nodes, source, target = ananse.influence.split_interactions(["A—B", "C—D"])
+    assert list(nodes[source]) == ["A", "C"]
+    assert list(nodes[target]) == ["B", "D"]
+
+    # names without a separator
+    for interactions in ["A—B", "C—D", "E"], ["E"]:
+        with pytest.raises(ValueError):
+            ananse.influence.split_interactions(interactions)
+
+
+def test_difference(source_network, target_network, outdir):
+    grn = ananse.influence.difference(source_network, target_network, edges=30)
+    assert grn.number_of_edges() == 21
+
+    # repeated interactions in the source network
+    network = pd.read_table(source_network)
+    dup_network = os.path.join(outdir, "duplicate_interactions.txt")
+    pd.concat([network, network]).to_csv(dup_network, sep="\t", index=False)
+    grn2 = ananse.influence.difference(dup_network, target_network, edges=None)
+    grn = ananse.influence.difference(source_network, target_network, edges=None)
+    assert sorted(grn2.edges) == sorted(grn.edges)
 
 
 def test_read_expression(influence_obj):
@@ -77,6 +111,38 @@ def test_influence_scores(influence_obj):
     assert len(line) == 8
 
 
+def test_fold_change_scores(source_network, target_network, diff_exp, outdir):
+    i = ananse.influence.Influence(
+        os.path.join(outdir, "fold_change.txt"),
+        diff_exp,
+        grn_source_file=source_network,
+        grn_target_file=target_network,
+        edges=30,
+    )
+    grn = i.grn
+    expression_change = i.expression_change
+    tfs = [n for n in grn.nodes if grn.out_degree(n) > 0]
+    pvals, target_fcs = ananse.influence.fold_change_scores(tfs, grn, expression_change)
+    assert len(pvals) == len(target_fcs) == len(tfs)
+
+    # same as a test per TF
+    genes = set(grn.nodes) & set(expression_change)
+    for tf, pval, target_fc in zip(tfs, pvals, target_fcs):
+        targets = set(grn[tf]) & genes
+        if len(targets) == 0 or len(genes - targets) == 0:
+            assert np.isnan(pval) and np.isnan(target_fc)
+            continue
+        target_fc_list = [expression_change[g].absfc for g in targets]
+        non_target_fc_list = [expression_change[g].absfc for g in genes - targets]
+        expected = mannwhitneyu(
+            target_fc_list, non_target_fc_list, method="asymptotic"
+        )[1]
+        assert pval == pytest.approx(expected)
+        assert target_fc == pytest.approx(
+            np.mean(target_fc_list) - np.mean(non_target_fc_list)
+        )
+
+
 def test_filter_tf():
     pass  # TODO
 
@@ -129,5 +195,33 @@ def test_run_influence(source_network, target_network, diff_exp, outdir):
         assert df.shape == params[2]
 
 
+def test_run_influence_many(source_network, target_network, diff_exp, outdir):
+    param_list = []
+    for select_after_join in True, False:
+        param_list.append(
+            {
+                "outfile": os.path.join(outdir, f"many_{select_after_join}.txt"),
+                "degenes": diff_exp,
+                "grn_source_file": source_network,
+                "grn_target_file": target_network,
+                "edges": 30,
+                "select_after_join": select_after_join,
+            }
+        )
+    outfiles = ananse.influence.run_influence_many(param_list, ncore=2)
+    assert outfiles == [params["outfile"] for params in param_list]
+    assert pd.read_table(outfiles[0]).shape == (2, 9)
+    assert pd.read_table(outfiles[1]).shape == (2, 9)
+    diff_network = pd.read_table(os.path.splitext(outfiles[0])[0] + "_diffnetwork.tsv")
+    assert diff_network.shape == (26, 3)
+
+    with pytest.raises(ValueError):
+        ananse.influence.run_influence_many(param_list[:1] * 2)
+    # distinct outfiles, but the same diffnetwork file
+    tsv_params = dict(param_list[0], outfile=os.path.splitext(outfiles[0])[0] + ".tsv")
+    with pytest.raises(ValueError):
+        ananse.influence.run_influence_many([param_list[0], tsv_params])
+
+
 def test_command_influence():
     pass  # TODO